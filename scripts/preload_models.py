@@ -8,22 +8,31 @@
 #
 print('Loading Python libraries...\n')
 import argparse
+import contextlib
+import hashlib
+import io
+import json
 import sys
 import os
+import threading
 import warnings
-from urllib import request
 from tqdm import tqdm
-from omegaconf import OmegaConf
-from huggingface_hub import HfFolder, hf_hub_url
+try:
+    # the Rust hf_transfer downloader splits each file into byte ranges
+    # that are fetched over parallel connections. It must be enabled
+    # before huggingface_hub is imported.
+    import hf_transfer
+    os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER','1')
+except ImportError:
+    hf_transfer = None
 from pathlib import Path
 from getpass_asterisk import getpass_asterisk
-from transformers import CLIPTokenizer, CLIPTextModel
 import traceback
 import requests
-import clip
-import transformers
-import torch
-transformers.logging.set_verbosity_error()
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# torch, transformers, omegaconf and huggingface_hub take several seconds
+# to import, so they are imported by the functions that need them
+os.environ.setdefault('TRANSFORMERS_VERBOSITY','error')
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -35,6 +44,8 @@ warnings.filterwarnings('ignore')
 Model_dir = './models/ldm/stable-diffusion-v1/'
 Default_config_file = './configs/models.yaml'
 SD_Configs = './configs/stable-diffusion'
+HF_transfer_connections = 16
+Assume_yes = False   # answer every prompt with its default (--yes)
 Datasets = {
     'stable-diffusion-1.5':  {
         'description': 'The newest Stable Diffusion version 1.5 weight file (4.27 GB)',
@@ -90,6 +101,28 @@ Config_preamble = '''# This file describes the alternative machine learning mode
 # and the width and height of the images it
 # was trained on.
 '''
+Bert_model = 'bert-base-uncased'
+Clip_model = 'openai/clip-vit-large-patch14'
+Safety_model = 'CompVis/stable-diffusion-safety-checker'
+Codeformer_model = [
+    'https://github.com/sczhou/CodeFormer/releases/download/v0.1.0/codeformer.pth',
+    'ldm/invoke/restoration/codeformer/weights/codeformer.pth'
+]
+Clipseg_model = [
+    'https://owncloud.gwdg.de/index.php/s/ioHbRzFx6th32hn/download',
+    'models/clipseg/clipseg_weights'
+]
+# one keep-alive session for every download, so that files fetched from
+# the same host reuse connections instead of repeating the TLS handshake
+Http_connections = 32
+Http_session = requests.Session()
+Http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=Http_connections))
+# byte-range requests from all downloads share this many connections, which
+# leaves room in the pool for the single-stream downloads and HEAD requests
+# running beside them (the pool discards connections beyond its size)
+Range_slots = threading.BoundedSemaphore(Http_connections - 8)
+# set on ^C so that download threads give up at their next chunk
+Stop_downloads = threading.Event()
 
 #---------------------------------------------
 def introduction():
@@ -120,6 +153,8 @@ Have fun!
 #---------------------------------------------
 def yes_or_no(prompt:str, default_yes=True):
     default = "y" if default_yes else 'n'
+    if Assume_yes:
+        return default_yes
     response = input(f'{prompt} [{default}] ') or default
     if default_yes:
         return response[0] not in ('n','N')
@@ -140,6 +175,8 @@ You may download the recommended models (about 10GB total), select a customized
 completely skip this step.
 '''
     )
+    if Assume_yes:
+        return 'recommended'
     selection = None
     while selection is None:
         choice = input('Download <r>ecommended models, <c>ustomize the list, or <s>kip this step? [r]: ')
@@ -152,7 +189,10 @@ completely skip this step.
     return selection
 
 #---------------------------------------------
-def select_datasets(action:str):
+def select_datasets(action:str, models:list=None):
+    if models:
+        return {ds:counter for counter,ds in enumerate(models,1)}
+    ds_list = [(name, meta['description'], meta['recommended']) for name, meta in Datasets.items()]
     done = False
     while not done:
         datasets = dict()
@@ -165,15 +205,15 @@ Choose the weight file(s) you wish to download. Before downloading you
 will be given the option to view and change your selections.
 '''
         )
-            for ds in Datasets.keys():
-                recommended = '(recommended)' if Datasets[ds]['recommended'] else ''
-                print(f'[{counter}] {ds}:\n    {Datasets[ds]["description"]} {recommended}')
-                if yes_or_no('    Download?',default_yes=Datasets[ds]['recommended']):
+            for ds, description, rec in ds_list:
+                recommended = '(recommended)' if rec else ''
+                print(f'[{counter}] {ds}:\n    {description} {recommended}')
+                if yes_or_no('    Download?',default_yes=rec):
                     datasets[ds]=counter
                     counter += 1
         else:
-            for ds in Datasets.keys():
-                if Datasets[ds]['recommended']:
+            for ds, description, rec in ds_list:
+                if rec:
                     datasets[ds]=counter
                     counter += 1
                 
@@ -225,7 +265,9 @@ This involves a few easy steps.
     (Yes, you have to accept two slightly different license agreements)
 '''
     )
-    input('Press <enter> when you are ready to continue:')
+    if not Assume_yes:
+        input('Press <enter> when you are ready to continue:')
+    from huggingface_hub import HfFolder
     print('(Fetching Hugging Face token from cache...',end='')
     access_token = HfFolder.get_token()
     if access_token is not None:
@@ -262,26 +304,89 @@ def migrate_models_ckpt():
         print(f'model.ckpt => {new_name}')
         os.rename(os.path.join(Model_dir,'model.ckpt'),os.path.join(Model_dir,new_name))
             
+#---------------------------------------------
+@contextlib.contextmanager
+def interruptible_executor(**kwargs):
+    '''
+    Like ThreadPoolExecutor used as a context manager, except that its
+    queued tasks are cancelled if the block raises. On ^C the running
+    downloads are also told to stop, through Stop_downloads, and are not
+    waited for; any other error only affects this executor's own tasks.
+    '''
+    executor = ThreadPoolExecutor(**kwargs)
+    try:
+        yield executor
+    except KeyboardInterrupt:
+        Stop_downloads.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown(wait=True)
+
+#---------------------------------------------
+def check_for_stop():
+    if Stop_downloads.is_set():
+        raise KeyboardInterrupt
+
 #---------------------------------------------
 def download_weight_datasets(models:dict, access_token:str):
+    from huggingface_hub import HfFolder
+    os.makedirs(Model_dir, exist_ok=True)
     migrate_models_ckpt()
-    successful = dict()
-    for mod in models.keys():
-        repo_id = Datasets[mod]['repo_id']
-        filename = Datasets[mod]['file']
-        success = download_with_resume(
-            repo_id=repo_id,
-            model_name=filename,
-            access_token=access_token
-        )
-        if success:
-            successful[mod] = True
+    # weight files are large and served from a CDN that throttles each
+    # connection, so fetch several of them at once
+    max_workers = int(os.environ.get('INVOKE_MAX_PARALLEL_DOWNLOADS',4))
+    completed = dict()
+    corrupt = list()
+    # checksums are computed in a separate pool, so that the next
+    # download can start while the previous file is being verified
+    with interruptible_executor(max_workers=max_workers) as downloads, interruptible_executor() as checks:
+        futures = {
+            downloads.submit(
+                download_with_resume,
+                repo_id=Datasets[mod]['repo_id'],
+                model_name=Datasets[mod]['file'],
+                access_token=access_token,
+            ): mod
+            for mod in models.keys()
+        }
+        verifications = dict()
+        for future in as_completed(futures):
+            mod = futures[future]
+            if future.result():
+                verifications[checks.submit(
+                    verify_checksum,
+                    repo_id=Datasets[mod]['repo_id'],
+                    model_name=Datasets[mod]['file'],
+                    access_token=access_token,
+                )] = mod
+            else:
+                completed[mod] = False
+                print(f'* {mod}: FAILED ({len(completed)}/{len(futures)})')
+        for future in as_completed(verifications):
+            mod = verifications[future]
+            completed[mod] = future.result()
+            if not completed[mod]:
+                corrupt.append(mod)
+            print(f'* {mod}: {"done" if completed[mod] else "FAILED"} ({len(completed)}/{len(futures)})')
+
+    # preserve the selection order; the first model becomes the default
+    successful = {mod:True for mod in models.keys() if completed[mod]}
     if len(successful) < len(models):
         print(f'\n\n** There were errors downloading one or more files. **')
-        print('Please double-check your license agreements, and your access token.')
-        HfFolder.delete_token()
-        print('Press any key to try again. Type ^C to quit.\n')
-        input()
+        if corrupt:
+            print(f'These files failed the checksum test and were removed: {", ".join(corrupt)}')
+        if len(successful) + len(corrupt) < len(models):
+            print('Please double-check your license agreements, and your access token.')
+            HfFolder.delete_token()
+        else:
+            # the token worked; only the transfers went wrong
+            HfFolder.save_token(access_token)
+        if not Assume_yes:
+            print('Press any key to try again. Type ^C to quit.\n')
+            input()
         return None
 
     HfFolder.save_token(access_token)
@@ -291,20 +396,39 @@ def download_weight_datasets(models:dict, access_token:str):
     
 #---------------------------------------------
 def download_with_resume(repo_id:str, model_name:str, access_token:str)->bool:
+    from huggingface_hub import hf_hub_url
     model_dest = os.path.join(Model_dir, model_name)
-    os.makedirs(os.path.dirname(model_dest), exist_ok=True)
     url = hf_hub_url(repo_id, model_name)
 
+    # a file completed on an earlier run needs no round trip to the hub
+    if is_verified(model_dest):
+        print(f'* {model_name}: verified file found. Skipping.')
+        return True
+    # from here on the file may change, so any earlier verification is void
+    if os.path.exists(f'{model_dest}.verified'):
+        os.remove(f'{model_dest}.verified')
+
     header = {"Authorization": f'Bearer {access_token}'}
     open_mode = 'wb'
     exist_size = 0
+
+    # hf_transfer writes its ranges out of order, so a copy it left behind
+    # has holes in it and cannot be resumed
+    if os.path.exists(f'{model_dest}.part'):
+        os.remove(f'{model_dest}.part')
     
     if os.path.exists(model_dest):
         exist_size = os.path.getsize(model_dest)
         header['Range'] = f'bytes={exist_size}-'
         open_mode = 'ab'
 
-    resp = requests.get(url, headers=header, stream=True)
+    resp = None
+    mirror = os.environ.get('INVOKE_LAN_MIRROR')
+    if mirror:
+        resp = fetch_from_mirror(f'{mirror.rstrip("/")}/{repo_id}/{model_name}', header)
+    from_mirror = resp is not None
+    if not from_mirror:
+        resp = Http_session.get(url, headers=header, stream=True)
     total = int(resp.headers.get('content-length', 0))
     
     if resp.status_code==416:  # "range not satisfiable", which means nothing to return
@@ -322,70 +446,371 @@ def download_with_resume(repo_id:str, model_name:str, access_token:str)->bool:
             print(f'*** ERROR DOWNLOADING {model_name}: {resp.text}')
             return False
 
-        with open(model_dest, open_mode) as file, tqdm(
+        if exist_size == 0 and hf_transfer is not None and not from_mirror:
+            resp.close()
+            if not download_with_hf_transfer(resp.url, model_dest, model_name, total):
+                return False
+        else:
+            with open(model_dest, open_mode) as file, tqdm(
+                    desc=model_name,
+                    initial=exist_size,
+                    total=total+exist_size,
+                    unit='iB',
+                    unit_scale=True,
+                    unit_divisor=1000,
+            ) as bar:
+                unflushed = 0
+                for data in resp.iter_content(chunk_size=1024):
+                    check_for_stop()
+                    size = file.write(data)
+                    bar.update(size)
+                    unflushed += size
+                    if unflushed >= 64*1024*1024:
+                        file.flush()
+                        drop_page_cache(file)
+                        unflushed = 0
+    except Exception as e:
+        print(f'An error occurred while downloading {model_name}: {str(e)}')
+        return False
+    return True
+
+#---------------------------------------------
+def verify_checksum(repo_id:str, model_name:str, access_token:str)->bool:
+    '''
+    Compare a downloaded weight file against the SHA256 that the hub
+    publishes for it (the X-Linked-Etag header of LFS files). A corrupt
+    file is deleted so that the next run downloads it again; a good one
+    is marked as verified. If the hub does not say what the checksum
+    should be, the file is accepted but not marked, so that the next run
+    checks it again.
+    '''
+    from huggingface_hub import hf_hub_url
+    model_dest = os.path.join(Model_dir, model_name)
+    if is_verified(model_dest):
+        return True
+
+    try:
+        resp = Http_session.head(
+            hf_hub_url(repo_id, model_name),
+            headers={"Authorization": f'Bearer {access_token}'},
+            allow_redirects=False,
+        )
+    except requests.RequestException as e:
+        print(f'** Could not fetch the checksum of {model_name}: {str(e)}')
+        return True
+    expected = resp.headers.get('x-linked-etag','').strip('"')
+    if resp.status_code >= 400 or len(expected) != 64:
+        print(f'** Could not fetch the checksum of {model_name} ({resp.status_code} {resp.reason}). It was not verified.')
+        return True
+
+    with open(model_dest, 'rb') as file:
+        digest = file_sha256(file)
+        drop_page_cache(file)
+    if digest != expected:
+        print(f'** {model_name} is corrupt (checksum mismatch). It will be downloaded again on the next run.')
+        os.remove(model_dest)
+        return False
+    mark_verified(model_dest, digest)
+    return True
+
+#---------------------------------------------
+def file_sha256(file)->str:
+    if hasattr(hashlib, 'file_digest'):   # python 3.11+
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+    sha256 = hashlib.sha256()
+    for data in iter(lambda: file.read(1024*1024), b''):
+        sha256.update(data)
+    return sha256.hexdigest()
+
+#---------------------------------------------
+def drop_page_cache(file):
+    '''
+    Ask the kernel to evict the file's pages from the page cache. Once
+    checksummed, the weight files are not read again by this script, so
+    caching them would only push other programs' data out of memory.
+    POSIX_FADV_DONTNEED skips pages that are still dirty, so the file is
+    written back first. Does nothing on platforms without posix_fadvise
+    (Windows, macOS).
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        os.fdatasync(file.fileno())
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+#---------------------------------------------
+def fetch_from_mirror(url:str, header:dict)->requests.Response:
+    '''
+    Try to fetch a weight file from the LAN mirror named by the
+    INVOKE_LAN_MIRROR environment variable (e.g. http://10.0.0.5:7860),
+    which serves files as <mirror>/<repo_id>/<filename>. Returns the
+    streaming response, or None if the mirror is unreachable or cannot
+    serve the file, in which case the caller goes to the hub.
+    '''
+    header = {k:v for k,v in header.items() if k != 'Authorization'}  # don't hand the token to the mirror
+    try:
+        resp = Http_session.get(url, headers=header, stream=True, timeout=5)
+    except requests.RequestException:
+        return None
+    if resp.status_code in ((206,416) if 'Range' in header else (200,)):
+        print(f'* Fetching {url} from LAN mirror')
+        return resp
+    resp.close()
+    return None
+
+#---------------------------------------------
+def mark_verified(model_dest:str, sha256:str):
+    '''
+    Leave a <model_dest>.verified file holding the file's checksum and
+    size, so that later runs can skip the file without contacting the hub.
+    '''
+    with open(f'{model_dest}.verified', 'w') as file:
+        file.write(f'{sha256} {os.path.getsize(model_dest)}')
+
+#---------------------------------------------
+def is_verified(model_dest:str)->bool:
+    '''
+    True if model_dest was verified by an earlier run and has not changed
+    size since. A .verified file in the old digest-only format doesn't
+    count.
+    '''
+    try:
+        with open(f'{model_dest}.verified') as file:
+            sha256, size = file.read().split()
+        return os.path.getsize(model_dest) == int(size)
+    except (OSError, ValueError):
+        return False
+
+#---------------------------------------------
+def download_with_hf_transfer(url:str, model_dest:str, model_name:str, total:int)->bool:
+    '''
+    Fetch a fresh copy of a weight file using hf_transfer. The ranges are
+    written out of order, so the file is assembled under <model_dest>.part
+    and only moved into place once it is complete; a .part left behind by
+    a failed or interrupted download is never resumed.
+    '''
+    part = f'{model_dest}.part'
+    try:
+        with tqdm(
                 desc=model_name,
-                initial=exist_size,
-                total=total+exist_size,
+                total=total,
                 unit='iB',
                 unit_scale=True,
                 unit_divisor=1000,
         ) as bar:
-            for data in resp.iter_content(chunk_size=1024):
-                size = file.write(data)
-                bar.update(size)
+            hf_transfer.download(
+                url=url,
+                filename=part,
+                max_files=HF_transfer_connections,
+                chunk_size=10*1024*1024,
+                max_retries=5,
+                callback=bar.update,
+            )
+        os.replace(part, model_dest)
     except Exception as e:
         print(f'An error occurred while downloading {model_name}: {str(e)}')
+        if os.path.exists(part):
+            os.remove(part)
         return False
     return True
-                             
+
+#---------------------------------------------
+def resumable_download(url:str, dest:str, connections:int=8):
+    '''
+    Download url to dest by way of dest.part, so that dest only appears
+    once it is complete. A fresh download of a large file is split into
+    concurrent byte-range requests. The server's ETag (or Last-Modified
+    date) is recorded in dest.etag and, if the download is interrupted,
+    it is resumed on the next run as long as the ETag still matches: a
+    single stream from the end of dest.part, or the byte ranges that
+    dest.ranges lists as still missing.
+    '''
+    part = f'{dest}.part'
+    etag_file = f'{dest}.etag'
+    ranges_file = f'{dest}.ranges'
+
+    head = Http_session.head(url, allow_redirects=True)
+    head.raise_for_status()
+    url = head.url    # skip the redirect on every subsequent request
+    total = int(head.headers.get('content-length', 0))
+    etag = head.headers.get('etag') or head.headers.get('last-modified')
+
+    offset = 0
+    ranges = None
+    if etag and os.path.exists(part) and os.path.exists(etag_file):
+        with open(etag_file) as file:
+            if file.read() == etag:
+                if os.path.exists(ranges_file):
+                    ranges = read_ranges(ranges_file)
+                else:
+                    offset = os.path.getsize(part)
+
+    # a .part file without a matching .etag sidecar is never resumed
+    if ranges is None:
+        for sidecar in (etag_file, ranges_file):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+
+    completed = offset > 0 and offset == total
+    if ranges is None and offset == 0 and total >= connections * 1024 * 1024:
+        with open(part, 'wb') as file:
+            file.truncate(total)
+        chunk = -(-total // connections)
+        ranges = [[start, min(start+chunk, total)-1] for start in range(0, total, chunk)]
+        # written before dest.etag, so that this .part is never mistaken
+        # for a prefix of the file
+        if etag:
+            with open(ranges_file, 'w') as file:
+                json.dump(ranges, file)
+    if etag:
+        with open(etag_file, 'w') as file:
+            file.write(etag)
+    if ranges is not None:
+        completed = parallel_http_download(url, part, ranges, ranges_file if etag else None, etag)
+        if not completed:
+            open(part, 'wb').close()   # start again as a single stream
+        if os.path.exists(ranges_file):
+            os.remove(ranges_file)
+        offset = 0
+    if not completed:
+        stream_http_download(url, part, offset, etag)
+
+    os.replace(part, dest)
+    if os.path.exists(etag_file):
+        os.remove(etag_file)
+
+#---------------------------------------------
+def read_ranges(ranges_file:str)->list:
+    '''
+    Returns the [start, end] byte ranges listed in ranges_file, or None if
+    the file cannot be read.
+    '''
+    try:
+        with open(ranges_file) as file:
+            return [[int(start), int(end)] for start,end in json.load(file)]
+    except (OSError, ValueError, TypeError):
+        return None
+
+#---------------------------------------------
+def parallel_http_download(url:str, dest:str, ranges:list, ranges_file:str=None, etag:str=None)->bool:
+    '''
+    Download the [start, end] byte ranges of url into dest, which must
+    already have its full size, using concurrent requests. Each range's
+    start is advanced as its data is written, and the ranges still missing
+    are saved to ranges_file so that an interrupted download can carry on
+    from there. Returns False if the server answers a range request with
+    the whole file, in which case the caller should fall back to a single
+    stream.
+    '''
+    lock = threading.Lock()
+    def save_progress():
+        if ranges_file is None:
+            return
+        with lock:
+            with open(f'{ranges_file}.tmp', 'w') as file:
+                json.dump([r for r in ranges if r[0] <= r[1]], file)
+            os.replace(f'{ranges_file}.tmp', ranges_file)
+
+    with interruptible_executor(max_workers=max(len(ranges),1)) as executor:
+        ranges_ok = list(executor.map(lambda r: download_http_range(url, dest, r, save_progress, etag), ranges))
+    return all(ranges_ok)
+
+#---------------------------------------------
+def download_http_range(url:str, dest:str, byte_range:list, save_progress, etag:str=None)->bool:
+    start, end = byte_range
+    headers = {'Range': f'bytes={start}-{end}'}
+    if etag:
+        headers['If-Range'] = etag   # send the whole file if it has changed
+    with Range_slots, Http_session.get(url, headers=headers, stream=True) as resp:
+        if resp.status_code != 206:  # server ignored the range
+            return False
+        written = 0
+        try:
+            with open(dest, 'r+b') as file:
+                file.seek(start)
+                for data in resp.iter_content(chunk_size=1024*1024):
+                    check_for_stop()
+                    written += file.write(data)
+                    if written - (byte_range[0] - start) >= 16*1024*1024:
+                        file.flush()
+                        byte_range[0] = start + written
+                        save_progress()
+        finally:
+            byte_range[0] = start + written
+            save_progress()
+    if byte_range[0] <= end:
+        raise requests.ConnectionError(f'{url}: connection closed before the end of bytes {start}-{end}')
+    return True
+
+#---------------------------------------------
+def stream_http_download(url:str, dest:str, offset:int=0, etag:str=None):
+    headers = dict()
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+        if etag:
+            headers['If-Range'] = etag   # send the whole file if it has changed
+    with Http_session.get(url, headers=headers, stream=True) as resp:
+        resp.raise_for_status()
+        open_mode = 'ab' if resp.status_code == 206 else 'wb'
+        with open(dest, open_mode) as file:
+            for data in resp.iter_content(chunk_size=1024*1024):
+                check_for_stop()
+                file.write(data)
+
 #---------------------------------------------
 def update_config_file(successfully_downloaded:dict,opt:dict):
     Config_file = opt.config_file or Default_config_file
+    if not successfully_downloaded:
+        print(f'** No new weight files were installed. {Config_file} left unchanged.')
+        return
     
-    yaml = new_config_file_contents(successfully_downloaded,Config_file)
-
+    import shutil
+    tmpfile = os.path.join(os.path.dirname(Config_file),'new_config.tmp')
     try:
-        if os.path.exists(Config_file):
-            print(f'** {Config_file} exists. Renaming to {Config_file}.orig')
-            os.rename(Config_file,f'{Config_file}.orig')
-        tmpfile = os.path.join(os.path.dirname(Config_file),'new_config.tmp')
+        # write the new file alongside the old one, then swap it into place
+        # with os.replace(), so that a crash never leaves a partial config
         with open(tmpfile, 'w') as outfile:
             outfile.write(Config_preamble)
-            outfile.write(yaml)
-        os.rename(tmpfile,Config_file)
+            new_config_file_contents(successfully_downloaded,Config_file,outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        if os.path.exists(Config_file):
+            print(f'** {Config_file} exists. Saving a copy as {Config_file}.orig')
+            shutil.copyfile(Config_file,f'{Config_file}.orig')
+        os.replace(tmpfile,Config_file)
 
     except Exception as e:
         print(f'**Error creating config file {Config_file}: {str(e)} **')
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
         return
 
     print(f'Successfully created new configuration file {Config_file}')
 
     
 #---------------------------------------------    
-def new_config_file_contents(successfully_downloaded:dict, Config_file:str)->str:
+def new_config_file_contents(successfully_downloaded:dict, Config_file:str, outfile):
+    from omegaconf import OmegaConf
     if os.path.exists(Config_file):
         conf = OmegaConf.load(Config_file)
     else:
         conf = OmegaConf.create()
 
-    # find the VAE file, if there is one
     vae = None
     default_selected = False
-    
-    for model in successfully_downloaded:
-        if Datasets[model]['config'] == 'VAE':
-            vae = Datasets[model]['file']
-    
-    for model in successfully_downloaded:
-        if Datasets[model]['config'] == 'VAE': # skip VAE entries
+
+    # visit the VAE file, if there is one, before the models that use it.
+    # The sort is stable, so the models otherwise keep their order.
+    for model in sorted(successfully_downloaded, key=lambda m: Datasets[m]['config']=='VAE', reverse=True):
+        meta = Datasets[model]
+        if meta['config'] == 'VAE':
+            vae = meta['file']
             continue
         stanza = conf[model] if model in conf else { }
         
-        stanza['description'] = Datasets[model]['description']
-        stanza['weights'] = os.path.join(Model_dir,Datasets[model]['file'])
-        stanza['config'] =os.path.join(SD_Configs, Datasets[model]['config'])
-        stanza['width'] = Datasets[model]['width']
-        stanza['height'] = Datasets[model]['height']
+        stanza['description'] = meta['description']
+        stanza['weights'] = os.path.join(Model_dir,meta['file'])
+        stanza['config'] =os.path.join(SD_Configs, meta['config'])
+        stanza['width'] = meta['width']
+        stanza['height'] = meta['height']
         stanza.pop('default',None)  # this will be set later
         if vae:
             stanza['vae'] = os.path.join(Model_dir,vae)
@@ -394,7 +819,7 @@ def new_config_file_contents(successfully_downloaded:dict, Config_file:str)->str
             stanza['default'] = True
             default_selected = True
         conf[model] = stanza
-    return OmegaConf.to_yaml(conf)
+    OmegaConf.save(conf, outfile)
     
 #---------------------------------------------
 # this will preload the Bert tokenizer fles
@@ -403,8 +828,8 @@ def download_bert():
     sys.stdout.flush()
     with warnings.catch_warnings():
         warnings.filterwarnings('ignore', category=DeprecationWarning)
-        from transformers import BertTokenizerFast, AutoFeatureExtractor
-        tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+        from transformers import BertTokenizerFast
+        tokenizer = BertTokenizerFast.from_pretrained(Bert_model)
         print('...success')
 
 #---------------------------------------------
@@ -419,67 +844,95 @@ def download_kornia():
 def download_clip():
     print('Loading CLIP model (ignore deprecation errors)...',end='')
     sys.stdout.flush()
-    version = 'openai/clip-vit-large-patch14'
-    tokenizer = CLIPTokenizer.from_pretrained(version)
-    transformer = CLIPTextModel.from_pretrained(version)
+    from transformers import CLIPTokenizer, CLIPTextModel
+    tokenizer = CLIPTokenizer.from_pretrained(Clip_model)
+    transformer = CLIPTextModel.from_pretrained(Clip_model)
     print('...success')
 
 #---------------------------------------------
 def download_gfpgan():
-    print('Installing models from RealESRGAN and facexlib  (ignore deprecation errors)...',end='')
-    try:
-        from realesrgan import RealESRGANer
-        from realesrgan.archs.srvgg_arch import SRVGGNetCompact
-        from facexlib.utils.face_restoration_helper import FaceRestoreHelper
-
-        RealESRGANer(
-            scale=4,
-            model_path='https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth',
-            model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=32, upscale=4, act_type='prelu')
-        )
+    print('Installing models from RealESRGAN, facexlib and GFPGAN...')
+    models = gfpgan_model_files()
 
-        FaceRestoreHelper(1, det_model='retinaface_resnet50')
-        print('...success')
-    except Exception:
-        print('Error loading ESRGAN:')
-        print(traceback.format_exc())
+    # all six files come from GitHub releases; fetch them together so that
+    # connection setup for one overlaps with the transfer of the others
+    for model_dir in {os.path.dirname(model_dest) for _,model_dest in models}:
+        os.makedirs(model_dir, exist_ok=True)
+    with interruptible_executor() as executor:
+        for model_url,model_dest in models:
+            executor.submit(download_model_file, model_url, model_dest)
 
-    print('Loading models from GFPGAN...',end='')
-    for model in (
+#---------------------------------------------
+def gfpgan_model_files()->list:
+    '''
+    Returns [url, destination] pairs for the GFPGAN, RealESRGAN and
+    facexlib weight files.
+    '''
+    models = [
+        [
+            'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth',
+            './models/gfpgan/GFPGANv1.4.pth'
+        ],
+        [
+            'https://github.com/xinntao/facexlib/releases/download/v0.1.0/detection_Resnet50_Final.pth',
+            './models/gfpgan/weights/detection_Resnet50_Final.pth'
+        ],
+        [
+            'https://github.com/xinntao/facexlib/releases/download/v0.2.2/parsing_parsenet.pth',
+            './models/gfpgan/weights/parsing_parsenet.pth'
+        ],
+    ]
+    import importlib.util
+    # RealESRGANer and FaceRestoreHelper download these weights the
+    # first time they are constructed. Put the files where those
+    # classes look for them instead of building the models here.
+    realesrgan_spec = importlib.util.find_spec('realesrgan')
+    facexlib_spec = importlib.util.find_spec('facexlib')
+    if realesrgan_spec is None or facexlib_spec is None:
+        print('** realesrgan and/or facexlib are not installed; skipping their weight files')
+        return models
+    try:
+        realesrgan_root = os.path.dirname(os.path.dirname(realesrgan_spec.origin))
+        facexlib_root = os.path.dirname(facexlib_spec.origin)
+        models.extend((
             [
-                'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth',
-                './models/gfpgan/GFPGANv1.4.pth'
+                'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-general-x4v3.pth',
+                os.path.join(realesrgan_root,'weights','realesr-general-x4v3.pth')
             ],
             [
                 'https://github.com/xinntao/facexlib/releases/download/v0.1.0/detection_Resnet50_Final.pth',
-                './models/gfpgan/weights/detection_Resnet50_Final.pth'
+                os.path.join(facexlib_root,'weights','detection_Resnet50_Final.pth')
             ],
             [
                 'https://github.com/xinntao/facexlib/releases/download/v0.2.2/parsing_parsenet.pth',
-                './models/gfpgan/weights/parsing_parsenet.pth'
+                os.path.join(facexlib_root,'weights','parsing_parsenet.pth')
             ],
-    ):
-        model_url,model_dest  = model
-        try:
-            if not os.path.exists(model_dest):
-                print(f'Downloading gfpgan model file {model_url}...',end='')
-                os.makedirs(os.path.dirname(model_dest), exist_ok=True)
-                request.urlretrieve(model_url,model_dest)
-                print('...success')
-        except Exception:
-            print('Error loading GFPGAN:')
-            print(traceback.format_exc())
+        ))
+    except Exception:
+        print('Error locating RealESRGAN and facexlib:')
+        print(traceback.format_exc())
+    return models
+
+#---------------------------------------------
+def download_model_file(model_url:str, model_dest:str):
+    try:
+        if not os.path.exists(model_dest):
+            print(f'Downloading model file {model_url}...')
+            resumable_download(model_url,model_dest)
+            print(f'{os.path.basename(model_dest)}...success')
+    except Exception:
+        print(f'Error downloading {model_url}:')
+        print(traceback.format_exc())
 
 #---------------------------------------------
 def download_codeformer():
     print('Installing CodeFormer model file...',end='')
     try:
-            model_url  = 'https://github.com/sczhou/CodeFormer/releases/download/v0.1.0/codeformer.pth'
-            model_dest = 'ldm/invoke/restoration/codeformer/weights/codeformer.pth'
+            model_url,model_dest = Codeformer_model
             if not os.path.exists(model_dest):
                 print('Downloading codeformer model file...')
                 os.makedirs(os.path.dirname(model_dest), exist_ok=True)
-                request.urlretrieve(model_url,model_dest)
+                resumable_download(model_url,model_dest)
     except Exception:
         print('Error loading CodeFormer:')
         print(traceback.format_exc())
@@ -488,20 +941,15 @@ def download_codeformer():
 #---------------------------------------------
 def download_clipseg():
     print('Installing clipseg model for text-based masking...',end='')
-    import zipfile
     try:
-        model_url  = 'https://owncloud.gwdg.de/index.php/s/ioHbRzFx6th32hn/download'
-        model_dest = 'models/clipseg/clipseg_weights'
-        weights_zip = 'models/clipseg/weights.zip'
+        model_url,model_dest = Clipseg_model
         
         if not os.path.exists(model_dest):
             os.makedirs(os.path.dirname(model_dest), exist_ok=True)
         if not os.path.exists(f'{model_dest}/rd64-uni-refined.pth'):
-            request.urlretrieve(model_url,weights_zip)
-            with zipfile.ZipFile(weights_zip,'r') as zip:
-                zip.extractall('models/clipseg')
-            os.remove(weights_zip)
+            download_and_extract_zip(model_url, 'models/clipseg')
 
+            import torch
             from clipseg.clipseg import CLIPDensePredT
             model = CLIPDensePredT(version='ViT-B/16', reduce_dim=64, )
             model.eval()
@@ -517,6 +965,22 @@ def download_clipseg():
         print(traceback.format_exc())
     print('...success')
 
+#-------------------------------------
+def download_and_extract_zip(url:str, dest_dir:str):
+    '''
+    Download a zip archive into memory and unpack it into dest_dir,
+    without writing the archive itself to disk.
+    '''
+    import zipfile
+    archive = io.BytesIO()
+    with Http_session.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        for data in resp.iter_content(chunk_size=1024*1024):
+            check_for_stop()
+            archive.write(data)
+    with zipfile.ZipFile(archive,'r') as zip:
+        zip.extractall(dest_dir)
+
 #-------------------------------------
 def download_safety_checker():
     print('Installing safety model for NSFW content detection...',end='')
@@ -527,11 +991,100 @@ def download_safety_checker():
         print('Error installing safety checker model:')
         print(traceback.format_exc())
         return
-    safety_model_id = "CompVis/stable-diffusion-safety-checker"
-    safety_feature_extractor = AutoFeatureExtractor.from_pretrained(safety_model_id)
-    safety_checker = StableDiffusionSafetyChecker.from_pretrained(safety_model_id)
+    safety_feature_extractor = AutoFeatureExtractor.from_pretrained(Safety_model)
+    safety_checker = StableDiffusionSafetyChecker.from_pretrained(Safety_model)
     print('...success')
 
+#-------------------------------------
+def print_download_plan(opt):
+    '''
+    Report what the script would download with the given options,
+    without importing torch or transformers or contacting any server.
+    '''
+    print('** DRY RUN: nothing will be downloaded **')
+    if (opt.interactive or opt.models) and not opt.no_weights:
+        models = opt.models or [ds for ds in Datasets if Datasets[ds]['recommended']]
+        print('\nWeight files' + ('' if opt.models else ' (the recommended set, unless changed at the prompt)') + ':')
+        for ds in models:
+            print(f'   {ds}: https://huggingface.co/{Datasets[ds]["repo_id"]}/resolve/main/{Datasets[ds]["file"]}')
+            print(f'      => {os.path.join(Model_dir, Datasets[ds]["file"])}')
+        print(f'   and an updated {opt.config_file or Default_config_file}')
+    if not opt.skip_support:
+        print('\nSupport models:')
+        for repo_id in (Bert_model, Clip_model, Safety_model):
+            print(f'   https://huggingface.co/{repo_id} => Hugging Face cache')
+        print('   Kornia requirements')
+        for model_url,model_dest in gfpgan_model_files() + [Codeformer_model, Clipseg_model]:
+            print(f'   {model_url}')
+            print(f'      => {model_dest}')
+
+#-------------------------------------
+class ThreadOutput(object):
+    '''
+    Stand-in for sys.stdout that collects the output of each task passed
+    to run() and prints it in one piece when the task finishes, so that
+    concurrent downloaders don't interleave their progress messages.
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def run(self, task):
+        self.local.buffer = io.StringIO()
+        try:
+            return task()
+        finally:
+            output = self.local.buffer.getvalue()
+            self.local.buffer = None
+            with self.lock:
+                self.stream.write(output)
+                self.stream.flush()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+#-------------------------------------
+def download_support_models():
+    # the support models come from unrelated repositories and land in
+    # different directories, so they can all be fetched at once
+    tasks = (
+        download_bert,
+        download_kornia,
+        download_clip,
+        download_gfpgan,
+        download_codeformer,
+        download_clipseg,
+        download_safety_checker,
+    )
+    # several tasks import these; importing them once here, before the
+    # threads start, avoids racing on the import lock of a half-loaded module
+    print('Loading torch and transformers...')
+    import torch
+    import transformers
+    import huggingface_hub
+    if hasattr(huggingface_hub, 'configure_http_backend'):  # huggingface_hub >= 0.14
+        huggingface_hub.configure_http_backend(backend_factory=lambda: Http_session)
+
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        with interruptible_executor(max_workers=len(tasks)) as executor:
+            list(executor.map(output.run, tasks))
+    finally:
+        sys.stdout = output.stream
+
 #-------------------------------------
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='InvokeAI model downloader')
@@ -546,15 +1099,64 @@ if __name__ == '__main__':
                         type=str,
                         default='./configs/models.yaml',
                         help='path to configuration file to create')
+    parser.add_argument('--yes',
+                        '-y',
+                        dest='yes',
+                        action='store_true',
+                        help='answer every question with its default, for unattended installs')
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--models',
+                           dest='models',
+                           type=str,
+                           default=None,
+                           help=f'comma-separated list of weight files to download, from: {", ".join(Datasets)}')
+    selection.add_argument('--selections',
+                           dest='selections',
+                           type=str,
+                           default=None,
+                           help='JSON file that maps weight file names to true or false, e.g. {"stable-diffusion-1.5": true}')
+    parser.add_argument('--no-weights',
+                        dest='no_weights',
+                        action='store_true',
+                        help='do not download any weight files')
+    parser.add_argument('--skip-support',
+                        dest='skip_support',
+                        action='store_true',
+                        help='do not download the support models (bert, CLIP, GFPGAN, etc.)')
+    parser.add_argument('--dry-run',
+                        dest='dry_run',
+                        action='store_true',
+                        help='list the files that would be downloaded and exit')
     opt = parser.parse_args()
+    # weight files named on the command line are downloaded even with
+    # --no-interactive, which then only means "don't ask"
+    Assume_yes = opt.yes or not opt.interactive
+    if opt.selections:
+        try:
+            with open(opt.selections) as file:
+                selections = json.load(file)
+        except (OSError, ValueError) as e:
+            parser.error(f'could not read {opt.selections}: {str(e)}')
+        if not isinstance(selections, dict):
+            parser.error(f'{opt.selections} must hold a JSON object, e.g. {{"stable-diffusion-1.5": true}}')
+        opt.models = [ds for ds,wanted in selections.items() if wanted]
+        opt.no_weights = opt.no_weights or not opt.models
+    elif opt.models:
+        opt.models = opt.models.split(',')
+    unknown = [ds for ds in opt.models or [] if ds not in Datasets]
+    if unknown:
+        parser.error(f'unknown model(s): {", ".join(unknown)}')
+    if opt.dry_run:
+        print_download_plan(opt)
+        sys.exit(0)
     
     try:
-        if opt.interactive:
+        if (opt.interactive or opt.models) and not opt.no_weights:
             introduction()
             print('** WEIGHT SELECTION **')
-            choice = user_wants_to_download_weights()
+            choice = 'customized' if opt.models else user_wants_to_download_weights()
             if choice != 'skip':
-                models = select_datasets(choice)
+                models = select_datasets(choice, opt.models)
                 if models is None:
                     if yes_or_no('Quit?',default_yes=False):
                         sys.exit(0)
@@ -562,20 +1164,25 @@ if __name__ == '__main__':
                 access_token = authenticate()
                 print('\n** DOWNLOADING WEIGHTS **')
                 successfully_downloaded = download_weight_datasets(models, access_token)
+                if successfully_downloaded is None:
+                    print(f'** Weight files were not installed. {opt.config_file} left unchanged.')
+                    sys.exit(1)
                 update_config_file(successfully_downloaded,opt)
-        print('\n** DOWNLOADING SUPPORT MODELS **')
-        download_bert()
-        download_kornia()
-        download_clip()
-        download_gfpgan()
-        download_codeformer()
-        download_clipseg()
-        download_safety_checker()
+        if not opt.skip_support:
+            print('\n** DOWNLOADING SUPPORT MODELS **')
+            download_support_models()
         postscript()
     except KeyboardInterrupt:
+        Stop_downloads.set()
         print('\nGoodbye! Come back soon.')
+        # don't wait for download threads that are still running (hf_transfer
+        # cannot be interrupted); whatever they leave behind is resumed or
+        # discarded on the next run
+        sys.stdout.flush()
+        os._exit(1)
     except Exception as e:
         print(f'\nA problem occurred during download.\nThe error was: "{str(e)}"')
+        sys.exit(1)
 
 
     
@@ -0,0 +1,212 @@
+import http.server
+import importlib.util
+import io
+import os
+import tempfile
+import threading
+import unittest
+import zipfile
+
+import requests
+
+script = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'preload_models.py')
+spec = importlib.util.spec_from_file_location('preload_models', script)
+preload_models = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(preload_models)
+
+DATA = os.urandom(3*1024*1024 + 123)
+ETAG = '"v1"'
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Serves content, honoring Range and If-Range unless ranges is False.
+    The response to a range starting at drop_range is cut off half way.
+    '''
+    content = DATA
+    ranges = True
+    drop_range = None
+    requested = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_headers(self) -> bytes:
+        requested_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        self.requested.append(requested_range)
+        if requested_range and self.ranges and if_range in (None, ETAG):
+            start, end = requested_range.split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else len(self.content)-1
+            body = self.content[start:end+1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(self.content)}')
+        else:
+            body = self.content
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        return body
+
+    def do_HEAD(self):
+        self.send_headers()
+
+    def do_GET(self):
+        body = self.send_headers()
+        if self.drop_range is not None and self.headers.get('Range', '').startswith(f'bytes={self.drop_range}-'):
+            RangeRequestHandler.drop_range = None
+            body = body[:len(body)//2]
+        self.wfile.write(body)
+
+
+class ResumableDownloadTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/weights.pth'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        RangeRequestHandler.ranges = True
+        RangeRequestHandler.drop_range = None
+        RangeRequestHandler.requested = []
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmpdir.name, 'weights.pth')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def assertDownloaded(self):
+        with open(self.dest, 'rb') as file:
+            self.assertEqual(file.read(), DATA)
+        self.assertFalse(os.path.exists(f'{self.dest}.part'))
+        self.assertFalse(os.path.exists(f'{self.dest}.etag'))
+        self.assertFalse(os.path.exists(f'{self.dest}.ranges'))
+
+    def test_fresh_download_is_split_into_ranges(self):
+        preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertDownloaded()
+        ranges = [r for r in RangeRequestHandler.requested if r]
+        self.assertEqual(len(ranges), 3)
+
+    def test_small_download_is_streamed(self):
+        preload_models.resumable_download(self.url, self.dest, connections=8)
+        self.assertDownloaded()
+        self.assertEqual(RangeRequestHandler.requested, [None, None])
+
+    def test_failed_range_does_not_stop_other_downloads(self):
+        RangeRequestHandler.drop_range = 0
+        with self.assertRaises(requests.RequestException):
+            preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertFalse(preload_models.Stop_downloads.is_set())
+        preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertDownloaded()
+
+    def test_interrupted_ranges_are_resumed(self):
+        RangeRequestHandler.drop_range = 0
+        with self.assertRaises(requests.RequestException):
+            preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertTrue(os.path.exists(f'{self.dest}.ranges'))
+        RangeRequestHandler.requested = []
+        preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertDownloaded()
+        ranges = [r for r in RangeRequestHandler.requested if r]
+        self.assertEqual(len(ranges), 1)
+        self.assertTrue(ranges[0].endswith(f'-{-(-len(DATA)//3) - 1}'))
+
+    def test_interrupted_ranges_when_server_stops_honoring_them(self):
+        RangeRequestHandler.drop_range = 0
+        with self.assertRaises(requests.RequestException):
+            preload_models.resumable_download(self.url, self.dest, connections=3)
+        RangeRequestHandler.ranges = False
+        preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertDownloaded()
+
+    def test_resume_from_part_file(self):
+        with open(f'{self.dest}.part', 'wb') as file:
+            file.write(DATA[:1000])
+        with open(f'{self.dest}.etag', 'w') as file:
+            file.write(ETAG)
+        preload_models.resumable_download(self.url, self.dest)
+        self.assertDownloaded()
+        self.assertEqual(RangeRequestHandler.requested[-1], 'bytes=1000-')
+
+    def test_part_file_with_stale_etag_is_not_resumed(self):
+        with open(f'{self.dest}.part', 'wb') as file:
+            file.write(b'x' * 1000)
+        with open(f'{self.dest}.etag', 'w') as file:
+            file.write('"v0"')
+        preload_models.resumable_download(self.url, self.dest, connections=8)
+        self.assertDownloaded()
+        self.assertEqual(RangeRequestHandler.requested, [None, None])
+
+    def test_part_file_without_etag_is_not_resumed(self):
+        with open(f'{self.dest}.part', 'wb') as file:
+            file.write(b'x' * 1000)
+        preload_models.resumable_download(self.url, self.dest, connections=8)
+        self.assertDownloaded()
+
+    def test_server_that_ignores_ranges(self):
+        RangeRequestHandler.ranges = False
+        preload_models.resumable_download(self.url, self.dest, connections=3)
+        self.assertDownloaded()
+
+    def test_resume_when_server_ignores_ranges(self):
+        RangeRequestHandler.ranges = False
+        with open(f'{self.dest}.part', 'wb') as file:
+            file.write(DATA[:1000])
+        with open(f'{self.dest}.etag', 'w') as file:
+            file.write(ETAG)
+        preload_models.resumable_download(self.url, self.dest)
+        self.assertDownloaded()
+
+
+class ZipRequestHandler(RangeRequestHandler):
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as zip:
+        zip.writestr('clipseg_weights/rd64-uni-refined.pth', DATA)
+    content = archive.getvalue()
+
+
+class DownloadAndExtractZipTestCase(unittest.TestCase):
+
+    def test_download_and_extract_zip(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ZipRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                preload_models.download_and_extract_zip(
+                    f'http://127.0.0.1:{server.server_port}/weights.zip', tmpdir
+                )
+                with open(os.path.join(tmpdir, 'clipseg_weights', 'rd64-uni-refined.pth'), 'rb') as file:
+                    self.assertEqual(file.read(), DATA)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class VerifiedSentinelTestCase(unittest.TestCase):
+
+    def test_sentinel_is_tied_to_file_size(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            model_dest = os.path.join(tmpdir, 'model.ckpt')
+            with open(model_dest, 'wb') as file:
+                file.write(b'weights')
+            self.assertFalse(preload_models.is_verified(model_dest))
+            preload_models.mark_verified(model_dest, '0' * 64)
+            self.assertTrue(preload_models.is_verified(model_dest))
+            with open(model_dest, 'ab') as file:
+                file.write(b'more')
+            self.assertFalse(preload_models.is_verified(model_dest))
+
+
+if __name__ == '__main__':
+    unittest.main()